@@ -1,23 +1,26 @@
+from dataclasses import dataclass
 from datetime import datetime
-from typing import NamedTuple
 
-import pandas as pd
+import pyarrow as pa
 
 
-class DatasetStats(NamedTuple):
+@dataclass(slots=True, frozen=True)
+class DatasetStats:
     query: str
     min_opened_date: datetime
     max_opened_date: datetime
 
 
-class StatsForYear(NamedTuple):
-    query: str | None
-    number_of_changesets: int | None
-    number_of_unique_users: int | None
-    number_of_object_changes: int | None
-    number_of_comments: int | None
+@dataclass(slots=True, frozen=True)
+class StatsForYear:
+    query: str
+    number_of_changesets: int
+    number_of_unique_users: int
+    number_of_object_changes: int
+    number_of_comments: int
 
 
-class DataFrameResult(NamedTuple):
+@dataclass(slots=True, frozen=True)
+class DataFrameResult:
     query: str
-    df: pd.DataFrame
+    table: pa.Table
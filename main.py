@@ -1,181 +1,254 @@
+import hashlib
 import os
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
 
 import duckdb
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 from datastructures import StatsForYear, DataFrameResult, DatasetStats
-from utils import get_delta, paths_for_years
+from precompute import (
+    SUMMARY_QUERIES,
+    configure_connection,
+    create_changesets_view,
+    load_remote_file_cache,
+    summaries_up_to_date,
+    summary_path,
+    write_summaries,
+)
+from utils import compute_deltas, narrow_types
+
+
+# results persisted on disk are keyed by this value and the query text,
+# bump it when source files are replaced with a new dump
+QUERY_CACHE_VERSION = "2"
 
 
 # ------------------------------------------------------------------------------------------------------
 # functions
 # ------------------------------------------------------------------------------------------------------
-@st.cache_data
-def fetch_one(query: str) -> tuple:
-    return db.execute(query).fetchone()  # type: ignore
+@st.cache_resource
+def get_db(url_template: str) -> duckdb.DuckDBPyConnection:
+    # create in-memory duckdb database 🦆
+    connection = duckdb.connect(database=":memory:")
+    configure_connection(connection)
+    load_remote_file_cache(connection)
+    create_changesets_view(connection, url_template)
+    warmup_metadata(connection, url_template)
+    return connection
+
+
+def warmup_metadata(db: duckdb.DuckDBPyConnection, url_template: str) -> None:
+    # counting rows only reads file footers which then stay in object cache,
+    # so later queries don't have to fetch them from S3 again
+    db.execute("SELECT count(*) FROM read_parquet($1)", (url_template.format(year="*"),))
+
+
+@st.cache_resource(show_spinner="Preparing per-year summaries, this can take a while on first start...")
+def prepare_summaries(url_template: str, summary_dir: str, min_year: int, max_year: int) -> None:
+    # summaries are normally shipped with the app (see precompute.py), build them only if they are missing or stale
+    if not summaries_up_to_date(summary_dir, url_template, min_year, max_year):
+        with db.cursor() as cursor:
+            write_summaries(cursor, url_template, summary_dir)
+
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    # pool for running independent queries concurrently
+    return ThreadPoolExecutor(max_workers=6)
+
+
+def run_in_background(function: Callable, *args) -> Future:
+    # worker threads need script run context to use streamlit caches
+    ctx = get_script_run_ctx()
+
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return function(*args)
+
+    return executor.submit(run)
+
+
+def persist_result(query: str, params: tuple = ()) -> str:
+    key = hashlib.blake2b(f"{QUERY_CACHE_VERSION}\n{query}\n{params!r}".encode()).hexdigest()
+    path = os.path.join(query_cache_dir, f"{key}.parquet")
+    if not os.path.exists(path):
+        # write to a temporary file first so other processes never read a partially written file
+        temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        # queries can run in worker threads and each of them needs its own cursor
+        with db.cursor() as cursor:
+            cursor.execute(f"COPY ({query}) TO '{temporary_path}' (FORMAT PARQUET, COMPRESSION ZSTD)", params)
+        os.replace(temporary_path, path)
+    return path
+
+
+@st.cache_data(ttl="1h", max_entries=64, show_spinner=False)
+def fetch_summary(query: str, params: tuple, summary_version: int) -> pa.Table:
+    # summaries are small local files so they are read directly instead of going through the query cache,
+    # summary_version (modification time of the file) makes entries of rebuilt summaries miss the cache
+    with db.cursor() as cursor:
+        return narrow_types(cursor.execute(query, params).fetch_arrow_table())
+
+
+def read_summary(name: str, query: str, *params) -> pa.Table:
+    path = summary_path(summary_dir, name)
+    return fetch_summary(query, (path, *params), os.stat(path).st_mtime_ns)
+
 
+@st.cache_data(ttl="1h", max_entries=64, show_spinner=False)
+def fetch_df(query: str, params: tuple = ()) -> DataFrameResult:
+    table = pq.read_table(persist_result(query, params))
+    return DataFrameResult(query, narrow_types(table))
 
-@st.cache_data
-def fetch_df(query: str) -> DataFrameResult:
-    result = db.execute(query)
-    return DataFrameResult(query, result.arrow().to_pandas(types_mapper=pd.ArrowDtype))
+
+def show_query(query: str, summary_name: str | None = None) -> None:
+    with st.expander("SQL query", expanded=False):
+        if summary_name is not None:
+            # numbers are read from a precomputed summary so the query that builds it is shown as well
+            st.caption("Summary built from the Parquet files by precompute.py:")
+            st.code(SUMMARY_QUERIES[summary_name], language="sql")
+            st.caption("Query reading the summary:")
+        st.code(query, language="sql")
 
 
+@st.cache_data(ttl="1h", max_entries=64, show_spinner=False)
 def min_max_timestamps(url_template: str) -> DatasetStats:
-    query = f"""
+    # min/max values are stored in row group statistics so only file footers need to be read,
+    # result is not persisted on disk so that newly added files are picked up once this cache expires
+    files = url_template.format(year='*')
+    query = """
+SELECT
+    min(stats_min_value::timestamp) start_range,
+    max(stats_max_value::timestamp) end_range,
+    count(*) = count(stats_min_value) AND count(*) = count(stats_max_value) has_statistics
+FROM parquet_metadata($1)
+WHERE path_in_schema = 'created_at'
+""".strip()
+    with db.cursor() as cursor:
+        *result, has_statistics = cursor.execute(query, (files,)).fetchone()
+    if not has_statistics:
+        # fall back to scanning the column if files were written without statistics
+        query = """
 SELECT
     min(created_at) start_range,
     max(created_at) end_range
-FROM '{url_template.format(year='*')}'
+FROM changesets
 """.strip()
-    result = fetch_one(query)
+        with db.cursor() as cursor:
+            result = cursor.execute(query).fetchone()
     return DatasetStats(query, *result)
 
 
-def year_stats(year: int, url_template: str) -> StatsForYear:
-    query = f"""
+def two_year_stats(year: int) -> dict[int, StatsForYear]:
+    # read selected and previous year in one go instead of issuing a separate query for each of them
+    query = """
 SELECT
-    count(*) number_of_changesets,
-    count(distinct uid) number_of_unique_users,
-    sum(num_changes) number_of_object_changes,
-    sum(comments_count) number_of_comments
-FROM '{url_template.format(year=year)}'
+    "year",
+    number_of_changesets,
+    number_of_unique_users,
+    number_of_object_changes,
+    number_of_comments
+FROM read_parquet($1)
+WHERE "year" BETWEEN $2 - 1 AND $2
 """.strip()
-    result = fetch_one(query)
-    return StatsForYear(query, *result)
+    rows = read_summary("year_summary", query, year).to_pylist()
+    return {row.pop("year"): StatsForYear(query, **row) for row in rows}
 
 
-def most_popular_editors(year: int, url_template: str) -> DataFrameResult:
-    query = f"""
+def editor_groupby_full(year: int) -> DataFrameResult:
+    # full grouping is cached so that other panels can reuse it without reading the summary again
+    query = """
 SELECT
-    CASE
-        WHEN created_by LIKE 'iD%' THEN 'iD'
-        WHEN created_by LIKE 'JOSM%' THEN 'JOSM'
-        WHEN created_by LIKE 'Level0%' THEN 'Level0'
-        WHEN created_by LIKE 'StreetComplete%' THEN 'StreetComplete'
-        WHEN created_by LIKE 'MapComplete%' THEN 'MapComplete'
-        WHEN created_by LIKE 'RapiD%' THEN 'RapiD'
-        WHEN created_by LIKE 'Rapid%' THEN 'RapiD'
-        WHEN created_by LIKE 'Potlach%' THEN 'Potlach'
-        WHEN created_by LIKE 'Potlatch%' THEN 'Potlatch'
-        WHEN created_by LIKE 'Go Map!!%' THEN 'Go Map!!'
-        WHEN created_by LIKE 'Merkaartor%' THEN 'Merkaartor'
-        WHEN created_by LIKE 'OsmAnd%' THEN 'OsmAnd'
-        WHEN created_by LIKE 'MAPS.ME%' THEN 'MAPS.ME'
-        WHEN created_by LIKE 'Vespucci%' THEN 'Vespucci'
-        WHEN created_by LIKE 'Organic Maps%' THEN 'Organic Maps'
-        WHEN created_by LIKE 'ArcGIS Editor%' THEN 'ArcGIS Editor'
-        WHEN created_by LIKE 'bulk_upload.py%' THEN 'bulk_upload.py'
-        WHEN created_by LIKE 'reverter%' THEN 'reverter'
-        WHEN created_by LIKE 'osm-revert%' THEN 'osm-revert'
-        WHEN created_by LIKE 'Every_Door%' THEN 'EveryDoor'
-        WHEN created_by LIKE 'osmtools%' THEN 'osmtools'
-        WHEN created_by LIKE 'osmapi%' THEN 'osmapi'
-        WHEN created_by LIKE 'rosemary%' THEN 'rosemary'
-        WHEN created_by LIKE 'Globe%' THEN 'Globe'
-        WHEN created_by LIKE 'PythonOsmApi%' THEN 'PythonOsmApi'
-        WHEN created_by LIKE 'bot-source-cadastre.py%' THEN 'bot-source-cadastre.py'
-        WHEN created_by LIKE 'upload.py%' THEN 'upload.py'
-        WHEN created_by LIKE 'osm-budynki-orto-import%' THEN 'osm-budynki-orto-import'
-        ELSE coalesce(created_by, '<unknown>')
-    END editor,
-    sum(num_changes)::bigint number_of_object_changes, -- cast to bigint makes formatting later easier
-    count(*) number_of_changesets
-FROM '{url_template.format(year=year)}'
-GROUP BY 1
-ORDER BY 2 DESC
-LIMIT 25
+    editor "Editor",
+    number_of_object_changes "Number Of Object Changes",
+    number_of_changesets "Number Of Changesets"
+FROM read_parquet($1)
+WHERE "year" = $2
+ORDER BY 2 DESC, 1
 """.strip()
-    return fetch_df(query)
+    return DataFrameResult(query, read_summary("editor_summary", query, year))
+
 
+def most_popular_editors(year: int, limit: int = 25) -> DataFrameResult:
+    result = editor_groupby_full(year)
+    return DataFrameResult(result.query, result.table.slice(0, limit))
 
-def get_sample_data(year: int, url_template: str) -> DataFrameResult:
-    query = f"""
-SELECT *
-FROM '{url_template.format(year=year)}'
+
+def get_sample_data(year: int) -> DataFrameResult:
+    # only columns used by the analyses are shown so wide columns like tags are not downloaded
+    query = """
+SELECT
+    created_at,
+    uid,
+    num_changes,
+    comments_count,
+    created_by,
+    locale
+FROM changesets
+WHERE "year" = $1
 LIMIT 10
 """.strip()
-    return fetch_df(query)
+    return fetch_df(query, (year,))
 
 
-def most_reported_locale(year: int, url_template: str) -> DataFrameResult:
-    query = f"""
+def most_reported_locale(year: int) -> DataFrameResult:
+    query = """
 SELECT
-    coalesce(locale, '<unknown>') reported_locale,
-    count(*) number_of_changesets,
+    locale "Reported Locale",
+    number_of_changesets "Number Of Changesets",
     round(
-        100.0 * count(*) / (SELECT count(*) FROM '{url_template.format(year=year)}'),
+        100.0 * number_of_changesets / sum(number_of_changesets) OVER (),
         2
-    ) || '%' as percentage_of_all_changesets
-FROM '{url_template.format(year=year)}'
-GROUP BY 1
-ORDER BY 2 DESC
+    ) || '%' as "Percentage Of All Changesets"
+FROM read_parquet($1)
+WHERE "year" = $2
+ORDER BY 2 DESC, 1
 LIMIT 15
 """.strip()
-    return fetch_df(query)
-
-
-def new_users(year: int, url_template: str) -> DataFrameResult:
-    paths_for_previous_years = paths_for_years(2005, year - 1, url_template)
-    sep = ",\n" + " " * 8
-    query = f"""
-WITH
-users_who_previously_edited as (
-    SELECT DISTINCT uid
-    FROM parquet_scan([
-        {sep.join(paths_for_previous_years)}
-    ])
-),
-users_who_edited_current_year as (
-    SELECT DISTINCT uid
-    FROM parquet_scan('{url_template.format(year=year)}')
-)
+    return DataFrameResult(query, read_summary("locale_summary", query, year))
+
+
+def new_users(year: int) -> DataFrameResult:
+    query = """
 SELECT
-    CASE
-        WHEN pe.uid IS NULL THEN true
-        ELSE false
-    END users_who_did_not_edit_before,
-    count(*) number_of_users
-FROM users_who_edited_current_year cu
-LEFT JOIN users_who_previously_edited pe USING(uid)
-GROUP BY 1
+    users_who_did_not_edit_before "Users Who Did Not Edit Before",
+    number_of_users "Number Of Users"
+FROM read_parquet($1)
+WHERE "year" = $2
+ORDER BY 1
 """.strip()
-    return fetch_df(query)
+    return DataFrameResult(query, read_summary("new_users_summary", query, year))
 
 
-def stats_over_years(url_template: str, max_year: int) -> DataFrameResult:
-    sep = ",\n" + " " * 4
-    query = f"""
+def stats_over_years(min_year: int, max_year: int) -> DataFrameResult:
+    query = """
 SELECT
-    regexp_extract(filename, '([0-9]{{4}})', 1) as "year",
-    sum(num_changes)::bigint as number_of_changes,
-    count(*) as number_of_changesets,
-    count(distinct uid) as number_of_unique_users
-FROM parquet_scan([
-    {sep.join(paths_for_years(2005, max_year, url_template))}
-], FILENAME = 1)
-GROUP BY 1
+    "year"::varchar as "Year",
+    number_of_object_changes as "Number Of Changes",
+    number_of_changesets as "Number Of Changesets",
+    number_of_unique_users as "Number Of Unique Users (Approx)"
+FROM read_parquet($1)
+WHERE "year" BETWEEN $2 AND $3
 ORDER BY 1
 """.strip()
-    return fetch_df(query)
+    return DataFrameResult(query, read_summary("year_summary", query, min_year, max_year))
 
 
 # ------------------------------------------------------------------------------------------------------
 # init
 # ------------------------------------------------------------------------------------------------------
-# create in-memory duckdb database 🦆
-db = duckdb.connect(database=":memory:")
-db.execute("""
-    install 'httpfs';
-    load 'httpfs';
-    set s3_region='eu-central-1';
-    set enable_http_metadata_cache=true;
-    set enable_object_cache=true;
-    set preserve_insertion_order=false;
-""")
-
 data_url_template = os.environ.get("url_template", "s3://tt-osm-changesets/full_by_year/{year}.zstd.parquet")
+db = get_db(data_url_template)
+executor = get_executor()
+
+query_cache_dir = os.environ.get("query_cache_dir", ".qcache")
+os.makedirs(query_cache_dir, exist_ok=True)
+summary_dir = os.environ.get("summary_dir", "summaries")
 
 # ------------------------------------------------------------------------------------------------------
 # beginning of the app
@@ -199,87 +272,85 @@ GitHub repo: https://github.com/ttomasz/tt-osm-changeset-analyzer
 is the year the changeset was opened in.**
 
 Each part shows corresponding SQL query that is executed by DuckDB.
+Per-year numbers come from small summaries built from the Parquet files beforehand,
+for those both the query building the summary and the query reading it are shown.
 
 First let's see range of timestamps in our files. Give it some time to load the data.
 """)
 dataset_stats = min_max_timestamps(data_url_template)
-with st.expander("SQL query", expanded=False):
-    st.code(dataset_stats.query, language="sql")
+show_query(dataset_stats.query)
 st.metric("Minimum changeset opening datetime", dataset_stats.min_opened_date.isoformat())
 st.metric("Maximum changeset opening datetime", dataset_stats.max_opened_date.isoformat())
 
 st.write("Let's see some charts")
+# range of years comes from the data so new files are picked up without code changes
+min_year = dataset_stats.min_opened_date.year
 max_year = dataset_stats.max_opened_date.year
-stats = stats_over_years(url_template=data_url_template, max_year=max_year)
-stats.df.columns = stats.df.columns.map(lambda x: str(x).replace("_", " ").title())
-with st.expander("SQL query", expanded=False):
-    st.code(stats.query, language="sql")
-st.line_chart(data=stats.df, x="year".title(), y="number_of_changes".replace("_", " ").title())
-st.line_chart(data=stats.df, x="year".title(), y="number_of_changesets".replace("_", " ").title())
-st.line_chart(data=stats.df, x="year".title(), y="number_of_unique_users".replace("_", " ").title())
-
-# year = st.slider("Select year for analysis:", min_value=2005, max_value=2023, value=2023, step=1)
-year_options = tuple(range(2005, max_year + 1))
-selected_year = st.selectbox("Select year for analysis:", options=year_options, index=len(year_options) - 1)
-previous_year = selected_year - 1 if selected_year > 2005 else None
-
-st.write("A sample of data from Parquet files:")
-sample_data = get_sample_data(selected_year, data_url_template)
-with st.expander("SQL query", expanded=False):
-    st.code(sample_data.query, language="sql")
-st.dataframe(data=sample_data.df, use_container_width=True)
-
-st.markdown(f"## In {selected_year} there were:")
-
-stats_for_year = year_stats(selected_year, data_url_template)
-if previous_year is not None:
-    stats_for_previous_year = year_stats(previous_year, data_url_template)
-else:
-    stats_for_previous_year = StatsForYear(None, None, None, None, None)
-with st.expander("SQL query", expanded=False):
-    st.code(stats_for_year.query, language="sql")
-col1, col2 = st.columns(2)
-col1.metric(
-    "Changesets open",
-    f"{stats_for_year.number_of_changesets:,d}",
-    get_delta(stats_for_year.number_of_changesets, stats_for_previous_year.number_of_changesets)
-)
-col2.metric(
-    "Unique users who opened a changeset",
-    f"{stats_for_year.number_of_unique_users:,d}",
-    get_delta(stats_for_year.number_of_unique_users, stats_for_previous_year.number_of_unique_users)
-)
-col1.metric(
-    "Objects edited",
-    f"{stats_for_year.number_of_object_changes:,d}",
-    get_delta(stats_for_year.number_of_object_changes, stats_for_previous_year.number_of_object_changes)
-)
-col2.metric(
-    "Comments in discussions under changesets",
-    f"{stats_for_year.number_of_comments:,d}",
-    get_delta(stats_for_year.number_of_comments, stats_for_previous_year.number_of_comments)
-)
-
-st.markdown("### Most popular editors")
-editor_result = most_popular_editors(selected_year, data_url_template)
-editor_result.df.columns = editor_result.df.columns.map(lambda x: str(x).replace("_", " ").title())
-with st.expander("SQL query", expanded=False):
-    st.code(editor_result.query, language="sql")
-st.dataframe(data=editor_result.df, use_container_width=True)
-
-st.markdown("### Most reported locale")
-locale_result = most_reported_locale(selected_year, data_url_template)
-locale_result.df.columns = locale_result.df.columns.map(lambda x: str(x).replace("_", " ").title())
-with st.expander("SQL query", expanded=False):
-    st.code(locale_result.query, language="sql")
-st.dataframe(data=locale_result.df, use_container_width=True)
-
-if selected_year > 2005:
-    st.markdown("### New vs old users")
-    new_users_result = new_users(selected_year, data_url_template)
-    new_users_result.df.columns = new_users_result.df.columns.map(lambda x: str(x).replace("_", " ").title())
-    with st.expander("SQL query", expanded=False):
-        st.code(new_users_result.query, language="sql")
-    st.dataframe(data=new_users_result.df, use_container_width=True)
-else:
-    st.empty()
+prepare_summaries(data_url_template, summary_dir, min_year, max_year)
+stats = stats_over_years(min_year=min_year, max_year=max_year)
+show_query(stats.query, "year_summary")
+# charts need pandas, other results are rendered straight from Arrow tables
+stats_df = stats.table.to_pandas()
+st.line_chart(data=stats_df, x="Year", y="Number Of Changes")
+st.line_chart(data=stats_df, x="Year", y="Number Of Changesets")
+st.line_chart(data=stats_df, x="Year", y="Number Of Unique Users (Approx)")
+
+
+# selecting a year reruns only this fragment, the intro and charts above are not rendered again
+@st.fragment
+def year_panel(min_year: int, max_year: int) -> None:
+    # year = st.slider("Select year for analysis:", min_value=2005, max_value=2023, value=2023, step=1)
+    year_options = tuple(range(min_year, max_year + 1))
+    selected_year = st.selectbox("Select year for analysis:", options=year_options, index=len(year_options) - 1)
+
+    # queries for selected year are independent so they are started together and awaited right before rendering
+    sample_data_future = run_in_background(get_sample_data, selected_year)
+    stats_by_year_future = run_in_background(two_year_stats, selected_year)
+    editor_future = run_in_background(most_popular_editors, selected_year)
+    locale_future = run_in_background(most_reported_locale, selected_year)
+    if selected_year > min_year:
+        new_users_future = run_in_background(new_users, selected_year)
+
+    st.write("A sample of data from Parquet files (columns used in the analyses):")
+    sample_data = sample_data_future.result()
+    show_query(sample_data.query)
+    st.dataframe(data=sample_data.table, use_container_width=True)
+
+    st.markdown(f"## In {selected_year} there were:")
+
+    stats_by_year = stats_by_year_future.result()
+    stats_for_year = stats_by_year[selected_year]
+    # summary has no row for the year before the first one so there is nothing to compare with
+    stats_for_previous_year = stats_by_year.get(selected_year - 1)
+    show_query(stats_for_year.query, "year_summary")
+    deltas = compute_deltas(stats_for_year, stats_for_previous_year)
+    col1, col2 = st.columns(2)
+    metric_labels = (
+        ("number_of_changesets", "Changesets open"),
+        ("number_of_unique_users", "Unique users who opened a changeset (approx)"),
+        ("number_of_object_changes", "Objects edited"),
+        ("number_of_comments", "Comments in discussions under changesets"),
+    )
+    for (name, label), column in zip(metric_labels, (col1, col2, col1, col2)):
+        column.metric(label, f"{getattr(stats_for_year, name):,d}", deltas[name])
+
+    st.markdown("### Most popular editors")
+    editor_result = editor_future.result()
+    show_query(editor_result.query, "editor_summary")
+    st.dataframe(data=editor_result.table, use_container_width=True)
+
+    st.markdown("### Most reported locale")
+    locale_result = locale_future.result()
+    show_query(locale_result.query, "locale_summary")
+    st.dataframe(data=locale_result.table, use_container_width=True)
+
+    if selected_year > min_year:
+        st.markdown("### New vs old users")
+        new_users_result = new_users_future.result()
+        show_query(new_users_result.query, "new_users_summary")
+        st.dataframe(data=new_users_result.table, use_container_width=True)
+    else:
+        st.empty()
+
+
+year_panel(min_year, max_year)
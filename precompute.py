@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import uuid
+
+import duckdb
+
+
+logger = logging.getLogger(__name__)
+
+
+# prefixes of created_by tag values and names of editors they are grouped under,
+# prefixes are LIKE patterns so "_" matches any character (e.g. "Every_Door" also matches "Every Door Android")
+# prefixes must not overlap, otherwise changesets would be counted more than once
+EDITOR_PREFIXES = (
+    ("iD", "iD"),
+    ("JOSM", "JOSM"),
+    ("Level0", "Level0"),
+    ("StreetComplete", "StreetComplete"),
+    ("MapComplete", "MapComplete"),
+    ("RapiD", "RapiD"),
+    ("Rapid", "RapiD"),
+    ("Potlach", "Potlach"),
+    ("Potlatch", "Potlatch"),
+    ("Go Map!!", "Go Map!!"),
+    ("Merkaartor", "Merkaartor"),
+    ("OsmAnd", "OsmAnd"),
+    ("MAPS.ME", "MAPS.ME"),
+    ("Vespucci", "Vespucci"),
+    ("Organic Maps", "Organic Maps"),
+    ("ArcGIS Editor", "ArcGIS Editor"),
+    ("bulk_upload.py", "bulk_upload.py"),
+    ("reverter", "reverter"),
+    ("osm-revert", "osm-revert"),
+    ("Every_Door", "EveryDoor"),
+    ("osmtools", "osmtools"),
+    ("osmapi", "osmapi"),
+    ("rosemary", "rosemary"),
+    ("Globe", "Globe"),
+    ("PythonOsmApi", "PythonOsmApi"),
+    ("bot-source-cadastre.py", "bot-source-cadastre.py"),
+    ("upload.py", "upload.py"),
+    ("osm-budynki-orto-import", "osm-budynki-orto-import"),
+)
+
+# file next to the summaries recording which data and years they were built from
+SUMMARY_METADATA_FILE = "metadata.json"
+
+# queries producing small per-year tables the app is served from
+SUMMARY_QUERIES = {
+    "year_summary": """
+SELECT
+    "year",
+    count(*) number_of_changesets,
+    approx_count_distinct(uid) number_of_unique_users,
+    sum(num_changes)::bigint number_of_object_changes, -- hugeint would be persisted as double
+    sum(comments_count)::bigint number_of_comments
+FROM changesets
+GROUP BY 1
+""".strip(),
+    "editor_summary": """
+SELECT
+    c."year",
+    coalesce(p.label, c.created_by, '<unknown>') editor,
+    sum(c.num_changes)::bigint number_of_object_changes,
+    count(*) number_of_changesets
+FROM changesets c
+LEFT JOIN editor_prefixes p ON c.created_by LIKE p.prefix || '%'
+GROUP BY 1, 2
+""".strip(),
+    "locale_summary": """
+SELECT
+    "year",
+    coalesce(locale, '<unknown>') locale,
+    count(*) number_of_changesets
+FROM changesets
+GROUP BY 1, 2
+""".strip(),
+    "new_users_summary": """
+WITH
+users_per_year as (
+    SELECT DISTINCT
+        uid,
+        "year"
+    FROM changesets
+)
+SELECT
+    "year",
+    users_who_did_not_edit_before,
+    count(*) number_of_users
+FROM (
+    SELECT
+        "year",
+        "year" = min("year") OVER (PARTITION BY uid) users_who_did_not_edit_before
+    FROM users_per_year
+)
+GROUP BY 1, 2
+""".strip(),
+}
+
+
+def configure_connection(db: duckdb.DuckDBPyConnection) -> None:
+    # settings are set globally so that cursors used by worker threads share them,
+    # scans are bound by S3 latency so there are more threads than cores to keep more requests in flight
+    db.execute(f"""
+        install 'httpfs';
+        load 'httpfs';
+        set global s3_region='eu-central-1';
+        set global http_timeout=60;
+        set global http_retries=3;
+        set global http_keep_alive=true;
+        set global threads={max(8, os.cpu_count() or 1)};
+        set global memory_limit='{os.environ.get("memory_limit", "4GB")}';
+        set global enable_http_metadata_cache=true;
+        set global enable_object_cache=true;
+        set global prefetch_all_parquet_files=true;
+        set global preserve_insertion_order=false;
+        set enable_progress_bar=false;
+    """)
+
+
+def load_remote_file_cache(db: duckdb.DuckDBPyConnection) -> None:
+    # cache_httpfs keeps recently read blocks of remote files so repeated scans don't download them again,
+    # blocks are kept in memory (256 blocks of 1 MiB), the default on-disk cache would copy the whole dataset locally
+    # it's a community extension so if it can't be installed queries simply keep reading from S3
+    try:
+        db.execute("""
+            INSTALL cache_httpfs FROM community;
+            LOAD cache_httpfs;
+            SET GLOBAL cache_httpfs_type='in_memory';
+            SET GLOBAL cache_httpfs_cache_block_size=1048576;
+            SET GLOBAL cache_httpfs_max_in_mem_cache_block_count=256;
+        """)
+    except duckdb.Error as e:
+        logger.warning("cache_httpfs extension is unavailable, remote files will be read without caching: %s", e)
+
+
+def create_changesets_view(db: duckdb.DuckDBPyConnection, url_template: str) -> None:
+    # one logical table over all yearly files, filters on year are used by DuckDB to skip whole files,
+    # year is taken from the file name only so digits in directory names are ignored
+    db.execute(f"""
+        CREATE OR REPLACE VIEW changesets AS
+        SELECT *, regexp_extract(filename, '([0-9]{{4}})[^/]*$', 1)::int as "year"
+        FROM read_parquet('{url_template.format(year="*")}', filename = true)
+    """)
+
+
+def summary_path(summary_dir: str, name: str) -> str:
+    return os.path.join(summary_dir, f"{name}.parquet")
+
+
+def summaries_up_to_date(summary_dir: str, url_template: str, min_year: int, max_year: int) -> bool:
+    metadata_path = os.path.join(summary_dir, SUMMARY_METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        return False
+    if not all(os.path.exists(summary_path(summary_dir, name)) for name in SUMMARY_QUERIES):
+        return False
+    # summaries built from another copy of the data or before a new yearly file was added are rebuilt
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+    return metadata == {"url_template": url_template, "min_year": min_year, "max_year": max_year}
+
+
+def write_summaries(db: duckdb.DuckDBPyConnection, url_template: str, summary_dir: str) -> None:
+    os.makedirs(summary_dir, exist_ok=True)
+    create_changesets_view(db, url_template)
+    db.execute("CREATE OR REPLACE TEMP TABLE editor_prefixes(prefix VARCHAR, label VARCHAR)")
+    db.executemany("INSERT INTO editor_prefixes VALUES (?, ?)", EDITOR_PREFIXES)
+    for name, query in SUMMARY_QUERIES.items():
+        path = summary_path(summary_dir, name)
+        # write to a temporary file first so the app never reads a partially written file
+        temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        db.execute(f"COPY ({query}) TO '{temporary_path}' (FORMAT PARQUET, COMPRESSION ZSTD)")
+        os.replace(temporary_path, path)
+    # metadata is written last so summaries are only considered complete after all of them were replaced
+    min_year, max_year = db.execute(
+        "SELECT min(\"year\"), max(\"year\") FROM read_parquet($1)", (summary_path(summary_dir, "year_summary"),)
+    ).fetchone()
+    metadata_path = os.path.join(summary_dir, SUMMARY_METADATA_FILE)
+    temporary_path = f"{metadata_path}.{uuid.uuid4().hex}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump({"url_template": url_template, "min_year": min_year, "max_year": max_year}, f)
+    os.replace(temporary_path, metadata_path)
+
+
+if __name__ == "__main__":
+    connection = duckdb.connect(database=":memory:")
+    configure_connection(connection)
+    load_remote_file_cache(connection)
+    write_summaries(
+        connection,
+        os.environ.get("url_template", "s3://tt-osm-changesets/full_by_year/{year}.zstd.parquet"),
+        os.environ.get("summary_dir", "summaries"),
+    )
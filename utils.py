@@ -1,12 +1,40 @@
+from dataclasses import fields
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from datastructures import StatsForYear
+
+
+# string columns with fewer distinct values than this are dictionary encoded
+MAX_DICTIONARY_CARDINALITY = 100
+INT32_RANGE = (-(2**31), 2**31 - 1)
+
+
 def get_delta(current_value: int, previous_value: int | None) -> str | None:
     if previous_value is None:
         return None
     return f"{(current_value - previous_value):+,d}"
 
 
-def stringify(path: str) -> str:
-    return f"'{path}'"
+def compute_deltas(current: StatsForYear, previous: StatsForYear | None) -> dict[str, str | None]:
+    return {
+        field.name: get_delta(getattr(current, field.name), getattr(previous, field.name, None))
+        for field in fields(StatsForYear)
+        if field.name != "query"
+    }
 
 
-def paths_for_years(start_year: int, end_year: int, url_template: str) -> list[str]:
-    return [stringify(url_template.format(year=year)) for year in range(start_year, end_year + 1)]
+def narrow_types(table: pa.Table) -> pa.Table:
+    # smaller types take less memory in cache and less time to serialize when sent to the browser
+    for index, column in enumerate(table.columns):
+        if pa.types.is_int64(column.type):
+            min_max = pc.min_max(column)
+            min_value, max_value = min_max["min"].as_py(), min_max["max"].as_py()
+            if min_value is not None and INT32_RANGE[0] <= min_value and max_value <= INT32_RANGE[1]:
+                table = table.set_column(index, table.field(index).with_type(pa.int32()), column.cast(pa.int32()))
+        elif pa.types.is_string(column.type):
+            if pc.count_distinct(column).as_py() < MAX_DICTIONARY_CARDINALITY:
+                encoded = column.dictionary_encode()
+                table = table.set_column(index, table.field(index).with_type(encoded.type), encoded)
+    return table